@@ -9,9 +9,27 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
 import pylast
 import os
+import argparse
+import functools
+import cProfile
+import tracemalloc
 import threading
+import queue
+import time
+import getpass
+import string
 from datetime import datetime, timedelta
+from collections import deque, Counter
 import json
+import gzip
+import logging
+import logging.handlers
+
+# inotify es opcional: sin él, el detector de reproductores consulta periódicamente
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
 
 # =============================================================================
 # CONFIGURACIÓN DE API
@@ -51,6 +69,73 @@ if not API_KEY or API_KEY == 'TU_API_KEY_AQUI':
 # Archivo para guardar sesión del usuario
 CONFIG_FILE = os.path.join(os.path.expanduser("~"), ".rockbox_scrobbler_session.json")
 
+# Registro de canciones ya enviadas (para no repetirlas al reconectar el reproductor)
+SUBMITTED_FILE = os.path.join(os.path.expanduser("~"), ".rockbox_scrobbler_submitted.json")
+
+# Log de importación: líneas visibles en la ventana y transcripción completa en disco
+LOG_FILE = os.path.join(os.path.expanduser("~"), ".rockbox_scrobbler_import.log")
+LOG_MAX_LINES = 1000
+LOG_FLUSH_MS = 100
+LOG_FILE_MAX_BYTES = 2 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+
+# Archivo local donde se guardan las líneas ya enviadas del .scrobbler.log
+ARCHIVE_FILE = os.path.join(os.path.expanduser("~"), ".rockbox_scrobbler_archive.log.gz")
+
+# Detección automática del reproductor
+SCROBBLER_LOG_NAME = ".scrobbler.log"
+DEVICE_POLL_SECONDS = 2
+DEVICE_STABLE_SECONDS = 3
+
+# Perfilado opcional (ROCKBOX_SCROBBLER_PROFILE=1 o --profile)
+PROFILE_ENABLED = os.getenv('ROCKBOX_SCROBBLER_PROFILE', '') not in ('', '0')
+PROFILE_DIR = os.path.join(os.path.expanduser("~"), ".rockbox_scrobbler_profiles")
+PROFILE_TOP_ALLOCATIONS = 25
+
+# Límites de Last.fm
+SCROBBLE_WINDOW_DAYS = 14
+MAX_FIELD_LENGTH = 1024
+# Las canciones ajustadas empiezan este margen después del límite, para que
+# no caduquen nada más cargar el archivo
+ADJUST_MARGIN_SECONDS = 3600
+
+# Envío por lotes ordenados por plazo
+SUBMIT_BATCH_SIZE = 50
+SUBMIT_INITIAL_RATE = 10  # canciones/s hasta tener una medida real
+SUBMIT_SAFETY_SECONDS = 300  # margen antes de que una canción salga de la ventana
+SUBMIT_REPLAN_BATCHES = 20  # replanificar al menos cada tantos lotes, por si baja el ritmo
+SUBMIT_RETRIES = 1
+SUBMIT_RETRY_DELAY = 5
+
+# Motivos por los que se descarta una canción antes de enviarla
+REJECT_REASONS = {
+    'missing_field': 'falta artista o título',
+    'too_old': 'fecha anterior a las últimas 2 semanas',
+    'too_new': 'fecha en el futuro',
+    'field_too_long': 'campo demasiado largo',
+    'duplicate': 'repetida en esta importación',
+}
+
+# Códigos de ignoredMessage devueltos por track.scrobble
+IGNORED_CODES = {
+    1: 'artista ignorado',
+    2: 'canción ignorada',
+    3: 'fecha demasiado antigua',
+    4: 'fecha demasiado reciente',
+    5: 'límite diario de scrobbles alcanzado',
+}
+DAILY_LIMIT_CODE = 5
+
+# Rechazos que no se arreglan reenviando ni cambiando el ajuste horario:
+# solo esas líneas (y las aceptadas) se pueden quitar del log del dispositivo
+PERMANENT_REJECT_REASONS = {'missing_field', 'field_too_long', 'duplicate'}
+PERMANENT_IGNORED_CODES = {1, 2}
+
+# Carga del archivo en segundo plano
+LOAD_CHUNK_SIZE = 500
+LOAD_POLL_MS = 50
+LOAD_CHUNKS_PER_TICK = 2
+
 # =============================================================================
 # FUNCIONES DE SESIÓN
 # =============================================================================
@@ -88,6 +173,142 @@ def clear_session():
             pass
 
 
+def load_submitted():
+    """Carga los identificadores (play_id) de las canciones ya enviadas"""
+    if os.path.exists(SUBMITTED_FILE):
+        try:
+            with open(SUBMITTED_FILE, 'r', encoding='utf-8') as f:
+                return set(json.load(f))
+        except (OSError, ValueError):
+            return set()
+    return set()
+
+
+def save_submitted(play_ids):
+    """Añade play_ids al registro de canciones enviadas (reemplazo atómico)"""
+    if not play_ids:
+        return
+    submitted = load_submitted() | set(play_ids)
+    tmp_path = SUBMITTED_FILE + '.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(sorted(submitted), f)
+        os.replace(tmp_path, SUBMITTED_FILE)
+    except OSError:
+        pass
+
+
+# =============================================================================
+# LOG DE IMPORTACIÓN
+# =============================================================================
+
+class LogBuffer:
+    """
+    Cola de mensajes para el log de la interfaz.
+    Acumula las líneas nuevas (como mucho max_lines, en buffer circular) hasta
+    que la interfaz las vuelca en bloque, y copia todo a un archivo rotativo.
+    El widget se recorta al mismo máximo al volcar.
+    """
+
+    def __init__(self, max_lines=LOG_MAX_LINES, log_file=LOG_FILE):
+        self.max_lines = max_lines
+        # Si llegan más líneas de las que caben antes de volcar, se pierden las más antiguas
+        self.pending = deque(maxlen=max_lines)
+        self.lock = threading.Lock()
+        self.file_logger = None
+
+        if log_file:
+            logger = logging.getLogger('rockbox_scrobbler')
+            try:
+                if not logger.handlers:
+                    handler = logging.handlers.RotatingFileHandler(
+                        log_file,
+                        maxBytes=LOG_FILE_MAX_BYTES,
+                        backupCount=LOG_FILE_BACKUPS,
+                        encoding='utf-8'
+                    )
+                    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+                    logger.addHandler(handler)
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+                self.file_logger = logger
+            except OSError:
+                # Sin acceso al disco: el log sigue funcionando solo en memoria
+                self.file_logger = None
+
+    def append(self, message):
+        """Añade un mensaje (puede contener varias líneas). Seguro entre hilos."""
+        new_lines = message.split('\n')
+        with self.lock:
+            self.pending.extend(new_lines)
+        if self.file_logger:
+            for line in new_lines:
+                self.file_logger.info(line)
+
+    def take_pending(self):
+        """Devuelve las líneas pendientes de mostrar y vacía la cola"""
+        with self.lock:
+            pending = list(self.pending)
+            self.pending.clear()
+        return pending
+
+
+# =============================================================================
+# PERFILADO
+# =============================================================================
+
+# cProfile no admite dos perfiles activos a la vez: solo se perfila la llamada
+# más externa y las anidadas (o de otros hilos) quedan incluidas o se omiten
+_profile_lock = threading.Lock()
+
+
+def write_profile_report(name, profiler, snapshot, peak):
+    """Guarda el .pstats y el informe de asignaciones de memoria de una ejecución"""
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    base = os.path.join(PROFILE_DIR, f"{stamp}-{name}")
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(f"{base}.pstats")
+        
+        with open(f"{base}-alloc.txt", 'w', encoding='utf-8') as f:
+            f.write(f"{name}: pico de memoria {peak / 1024:.1f} KiB\n\n")
+            if snapshot:
+                snapshot = snapshot.filter_traces((
+                    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                ))
+                for stat in snapshot.statistics('lineno')[:PROFILE_TOP_ALLOCATIONS]:
+                    f.write(f"{stat}\n")
+    except OSError:
+        pass
+
+
+def profiled(func):
+    """Perfila la función con cProfile y tracemalloc cuando el perfilado está activo"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not PROFILE_ENABLED or not _profile_lock.acquire(blocking=False):
+            return func(*args, **kwargs)
+        
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            if started_tracing:
+                tracemalloc.stop()
+            _profile_lock.release()
+            write_profile_report(func.__name__, profiler, snapshot, peak)
+    
+    return wrapper
+
+
 # =============================================================================
 # FUNCIONES DE PROCESAMIENTO
 # =============================================================================
@@ -97,10 +318,147 @@ def adjust_timestamp(timestamp, hours_offset):
     return timestamp + (hours_offset * 3600)
 
 
-def adjust_old_scrobbles(scrobbles, two_weeks_limit):
+def apply_timezone_offset(scrobbles, hours_offset):
+    """Devuelve copias de los scrobbles con el desfase horario aplicado"""
+    shifted = []
+    for scrobble in scrobbles:
+        timestamp = adjust_timestamp(scrobble['timestamp'], hours_offset)
+        shifted_scrobble = scrobble.copy()
+        shifted_scrobble['timestamp'] = timestamp
+        shifted_scrobble['date_str'] = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+        shifted.append(shifted_scrobble)
+    return shifted
+
+
+def merge_intervals(intervals):
+    """Ordena y fusiona intervalos (inicio, fin) solapados"""
+    merged = []
+    for begin, end in sorted(intervals):
+        if merged and begin <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([begin, end])
+    return merged
+
+
+def avoid_busy_intervals(timestamps, lengths, busy, lower, upper):
+    """
+    Desplaza los timestamps (ya ordenados) lo mínimo necesario para que ninguna
+    canción [t, t + duración) se solape con los intervalos ocupados ni con la anterior.
+    Primero empuja hacia delante; si la última se sale de upper, empuja hacia atrás.
+    """
+    result = []
+    j = 0
+    prev_end = lower
+    for t, length in zip(timestamps, lengths):
+        t = max(t, prev_end)
+        while j < len(busy) and busy[j][1] <= t:
+            j += 1
+        while j < len(busy) and busy[j][0] < t + length:
+            t = max(t, busy[j][1])
+            j += 1
+        result.append(t)
+        prev_end = t + length
+    
+    if result[-1] <= upper:
+        return result
+    
+    k = len(busy) - 1
+    next_start = upper + lengths[-1]
+    for i in range(len(result) - 1, -1, -1):
+        length = lengths[i]
+        t = min(result[i], next_start - length)
+        while k >= 0 and busy[k][0] >= t + length:
+            k -= 1
+        while k >= 0 and busy[k][1] > t:
+            t = min(t, busy[k][0] - length)
+            k -= 1
+        result[i] = t
+        next_start = t
+    
+    return result
+
+
+def fit_ordered_timestamps(targets, lengths, lower, upper):
+    """
+    Ajuste isotónico (PAV): timestamps lo más cerca posible de los objetivos
+    (mínimos cuadrados), en el mismo orden y separados por lengths.
+    """
+    n = len(targets)
+    offsets = [0] * n
+    for i, gap in enumerate(lengths[:-1], 1):
+        offsets[i] = offsets[i - 1] + gap
+    
+    # Restando el desplazamiento acumulado, la condición t[i] >= t[i-1] + gap
+    # pasa a ser una sucesión no decreciente: regresión isotónica (PAV)
+    blocks = []  # [suma, cantidad]
+    for target, offset in zip(targets, offsets):
+        blocks.append([target - offset, 1])
+        while len(blocks) > 1 and blocks[-2][0] * blocks[-1][1] > blocks[-1][0] * blocks[-2][1]:
+            total, count = blocks.pop()
+            blocks[-1][0] += total
+            blocks[-1][1] += count
+    
+    min_base = lower
+    max_base = max(lower, upper - offsets[-1])
+    
+    result = []
+    for total, count in blocks:
+        base = min(max(round(total / count), min_base), max_base)
+        for _ in range(count):
+            result.append(base + offsets[len(result)])
+    
+    return result
+
+
+def assign_unique_timestamps(targets, gaps, lower, upper, busy=()):
+    """
+    Asigna timestamps enteros estrictamente crecientes lo más cerca posible
+    de los objetivos, respetando el orden.
+    Entre la canción i y la siguiente quedan al menos gaps[i] segundos
+    (o menos, proporcionalmente, si no caben), ninguna se solapa con los
+    intervalos (inicio, fin) de busy y todas caen dentro de [lower, upper].
+    """
+    n = len(targets)
+    if n == 0:
+        return []
+    
+    lengths = [max(1, int(g)) for g in gaps]
+    busy = merge_intervals(busy)
+    
+    # Si las duraciones no caben en el tiempo libre, se reducen proporcionalmente
+    occupied = sum(max(0, min(end, upper) - max(begin, lower)) for begin, end in busy)
+    free = max(n, upper - lower - occupied)
+    total_gap = sum(lengths[:-1])
+    if total_gap > free:
+        scale = free / total_gap
+        lengths = [max(1, int(g * scale)) for g in lengths]
+    
+    while True:
+        result = fit_ordered_timestamps(targets, lengths, lower, upper)
+        if not busy:
+            return result
+        
+        # Las canciones que no se mueven ocupan su propio hueco
+        result = avoid_busy_intervals(result, lengths, busy, lower, upper)
+        overflow = lower - result[0]
+        if overflow <= 0 or max(lengths) == 1:
+            return result
+        
+        # El hueco que queda delante de cada intervalo ocupado no se aprovecha
+        # y las primeras se salen por abajo: reducir las duraciones y repetir
+        scale = min(0.95, max(0.5, 1 - overflow / sum(lengths)))
+        lengths = [max(1, int(g * scale)) for g in lengths]
+
+
+@profiled
+def adjust_old_scrobbles(scrobbles, two_weeks_limit, fixed=()):
     """
     Ajusta scrobbles antiguos para que quepan dentro del límite de 2 semanas.
-    Mantiene el orden relativo y la hora del día.
+    Mantiene el orden relativo y la hora del día, sin repetir timestamps.
+    Cada canción ajustada guarda en 'shift' cuántos segundos se movió
+    respecto a su hora ideal. Las canciones de fixed no se devuelven, pero
+    ocupan su hueco igual que las que ya estaban dentro de la ventana.
     """
     adjusted = []
     old_scrobbles = []
@@ -122,13 +480,15 @@ def adjust_old_scrobbles(scrobbles, two_weeks_limit):
     original_span = (newest_old_date - oldest_date).total_seconds()
     
     limit_date = two_weeks_limit
+    now = datetime.now()
     
+    targets = []
     for i, scrobble in enumerate(old_scrobbles):
         original_date = datetime.fromtimestamp(scrobble['timestamp'])
         
         if original_span > 0:
             proportion = (scrobble['timestamp'] - old_scrobbles[0]['timestamp']) / original_span
-            available_span = (datetime.now() - limit_date).total_seconds()
+            available_span = (now - limit_date).total_seconds()
             new_offset = proportion * available_span
             new_timestamp = int(limit_date.timestamp() + new_offset)
         else:
@@ -143,25 +503,207 @@ def adjust_old_scrobbles(scrobbles, two_weeks_limit):
             minute=original_time.minute,
             second=original_time.second
         )
+        targets.append(int(new_date.timestamp()))
+    
+    # Separar las canciones al menos su duración para que Last.fm no las descarte
+    gaps = [scrobble.get('length', 0) for scrobble in old_scrobbles]
+    # ...ni encima de las canciones que ya estaban dentro de la ventana
+    busy = [(s['timestamp'], s['timestamp'] + max(1, s.get('length', 0)))
+            for s in adjusted + list(fixed)]
+    timestamps = assign_unique_timestamps(
+        targets, gaps,
+        int(limit_date.timestamp()) + ADJUST_MARGIN_SECONDS,
+        int(now.timestamp()),
+        busy
+    )
+    
+    for scrobble, target, timestamp in zip(old_scrobbles, targets, timestamps):
+        original_date = datetime.fromtimestamp(scrobble['timestamp'])
+        new_date = datetime.fromtimestamp(timestamp)
         
         adjusted_scrobble = scrobble.copy()
-        adjusted_scrobble['timestamp'] = int(new_date.timestamp())
+        adjusted_scrobble['timestamp'] = timestamp
         adjusted_scrobble['date_str'] = new_date.strftime('%Y-%m-%d %H:%M:%S')
         adjusted_scrobble['was_adjusted'] = True
-        adjusted_scrobble['original_date'] = original_date.strftime('%Y-%m-%d %H:%M:%S')
+        # Si ya se había ajustado antes, se conserva la fecha realmente original
+        adjusted_scrobble['original_date'] = scrobble.get(
+            'original_date', original_date.strftime('%Y-%m-%d %H:%M:%S'))
+        adjusted_scrobble['shift'] = timestamp - target
         
         adjusted.append(adjusted_scrobble)
     
     return adjusted, len(old_scrobbles)
 
 
-def parse_scrobbler_log(filepath, timezone_offset=0):
-    """Parsea el archivo .scrobbler.log de Rockbox"""
-    scrobbles = []
+def validate_scrobbles(scrobbles, now=None):
+    """
+    Filtra localmente las canciones que Last.fm rechazaría.
+    Devuelve (válidas, descartadas), con descartadas como lista de (scrobble, motivo).
+    """
+    if now is None:
+        now = datetime.now()
+    oldest = (now - timedelta(days=SCROBBLE_WINDOW_DAYS)).timestamp()
+    newest = now.timestamp()
+    
+    valid = []
+    rejected = []
+    seen = set()
+    
+    for scrobble in scrobbles:
+        artist = scrobble['artist'].strip()
+        title = scrobble['title'].strip()
+        album = (scrobble.get('album') or '').strip()
+        
+        if not artist or not title:
+            reason = 'missing_field'
+        elif max(len(artist), len(title), len(album)) > MAX_FIELD_LENGTH:
+            reason = 'field_too_long'
+        elif scrobble['timestamp'] < oldest:
+            reason = 'too_old'
+        elif scrobble['timestamp'] > newest:
+            reason = 'too_new'
+        else:
+            key = (artist.lower(), title.lower(), scrobble['timestamp'])
+            reason = 'duplicate' if key in seen else None
+            seen.add(key)
+        
+        if reason:
+            rejected.append((scrobble, reason))
+            continue
+        
+        clean = scrobble.copy()
+        clean['artist'] = artist
+        clean['title'] = title
+        clean['album'] = album
+        valid.append(clean)
+    
+    return valid, rejected
+
+
+def submit_scrobbles(network, scrobbles):
+    """
+    Envía un lote de canciones con track.scrobble.
+    Devuelve una lista de códigos ignoredMessage (0 = aceptada) en el mismo orden,
+    o None para todas si la respuesta no permite saber qué pasó con cada una.
+    """
+    params = {}
+    for i, scrobble in enumerate(scrobbles):
+        params[f'artist[{i}]'] = scrobble['artist']
+        params[f'track[{i}]'] = scrobble['title']
+        params[f'timestamp[{i}]'] = str(scrobble['timestamp'])
+        if scrobble.get('album'):
+            params[f'album[{i}]'] = scrobble['album']
+        if scrobble.get('length'):
+            params[f'duration[{i}]'] = str(scrobble['length'])
+    
+    # pylast.scrobble() no devuelve la respuesta, así que se hace la petición
+    # directamente con pylast._Request (API interna, probada con pylast 5.x:
+    # _Request(network, método, params).execute() devuelve el XML como minidom)
+    request_class = getattr(pylast, '_Request', None)
+    if request_class is None:
+        raise RuntimeError(f"pylast {getattr(pylast, '__version__', '?')} no tiene _Request; "
+                           f"esta versión no es compatible")
+    doc = request_class(network, 'track.scrobble', params).execute()
+    
+    codes = []
+    for node in doc.getElementsByTagName('scrobble'):
+        ignored = node.getElementsByTagName('ignoredMessage')
+        code = ignored[0].getAttribute('code') if ignored else ''
+        codes.append(int(code) if code.isdigit() else 0)
+    
+    if not codes:
+        raise RuntimeError("Respuesta inesperada de track.scrobble: sin resultados")
+    if len(codes) != len(scrobbles):
+        # Last.fm respondió, pero no se puede emparejar cada resultado con su canción
+        return [None] * len(scrobbles)
+    
+    return codes
+
+
+def scrobble_deadline(scrobble, now):
+    """Segundos que le quedan a una canción antes de salir de la ventana de Last.fm"""
+    return scrobble['timestamp'] + SCROBBLE_WINDOW_DAYS * 24 * 3600 - now
+
+
+def plan_submission(scrobbles, rate, now=None):
+    """
+    Ordena las canciones pendientes por plazo (primero las que antes caducan)
+    y estima cuándo se enviará cada una al ritmo medido (canciones/s).
+    Devuelve (a_tiempo, en_riesgo, segundos_estimados_para_todas).
+    """
+    if now is None:
+        now = time.time()
+    
+    on_time = []
+    at_risk = []
+    for scrobble in sorted(scrobbles, key=lambda s: s['timestamp']):
+        send_eta = (len(on_time) + 1) / rate
+        if scrobble_deadline(scrobble, now) - send_eta < SUBMIT_SAFETY_SECONDS:
+            at_risk.append(scrobble)
+        else:
+            on_time.append(scrobble)
+    
+    return on_time, at_risk, len(scrobbles) / rate
+
+
+def replan_expiring(scrobbles, others, eta_seconds):
+    """
+    Adelanta, en su orden, las canciones que caducarían antes de enviarse a los
+    primeros huecos libres tras el momento estimado de fin de la importación.
+    Las demás canciones pendientes (others) no se mueven y no se pisan.
+    """
+    now = int(time.time())
+    lower = now - SCROBBLE_WINDOW_DAYS * 24 * 3600 + int(eta_seconds) + SUBMIT_SAFETY_SECONDS
+    
+    scrobbles = sorted(scrobbles, key=lambda s: s['timestamp'])
+    lengths = [max(1, s.get('length', 0)) for s in scrobbles]
+    busy = merge_intervals((s['timestamp'], s['timestamp'] + max(1, s.get('length', 0)))
+                           for s in others)
+    timestamps = avoid_busy_intervals([lower] * len(scrobbles), lengths, busy, lower, now)
+    
+    replanned = []
+    for scrobble, timestamp in zip(scrobbles, timestamps):
+        original_date = datetime.fromtimestamp(scrobble['timestamp'])
+        
+        moved = scrobble.copy()
+        moved['timestamp'] = timestamp
+        moved['date_str'] = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+        moved['was_adjusted'] = True
+        moved['original_date'] = scrobble.get(
+            'original_date', original_date.strftime('%Y-%m-%d %H:%M:%S'))
+        moved['shift'] = scrobble.get('shift', 0) + timestamp - scrobble['timestamp']
+        replanned.append(moved)
     
-    with open(filepath, 'r', encoding='utf-8', errors='replace') as f:
-        for line_num, line in enumerate(f, 1):
-            line = line.strip()
+    return replanned
+
+
+def prepare_submission(scrobbles, rate=SUBMIT_INITIAL_RATE):
+    """
+    Reajusta las canciones caducadas o que caducarían antes de enviarse y
+    después valida la lista completa. Devuelve (válidas ordenadas por plazo,
+    descartadas, cuántas se reajustaron).
+    """
+    on_time, at_risk, eta = plan_submission(scrobbles, rate)
+    if at_risk:
+        on_time += replan_expiring(at_risk, on_time, eta)
+    
+    valid, rejected = validate_scrobbles(on_time)
+    valid.sort(key=lambda s: s['timestamp'])
+    return valid, rejected, len(at_risk)
+
+
+def iter_scrobbler_log(filepath, timezone_offset=0, chunk_size=LOAD_CHUNK_SIZE):
+    """
+    Parsea el archivo .scrobbler.log de Rockbox por bloques.
+    Produce tuplas (scrobbles, bytes_leidos) cada chunk_size canciones válidas.
+    """
+    chunk = []
+    bytes_read = 0
+    
+    with open(filepath, 'rb') as f:
+        for line_num, raw_line in enumerate(f, 1):
+            bytes_read += len(raw_line)
+            line = raw_line.decode('utf-8', errors='replace').strip()
             
             if not line:
                 continue
@@ -174,6 +716,7 @@ def parse_scrobbler_log(filepath, timezone_offset=0):
             artist = parts[0].strip()
             album = parts[1].strip()
             track = parts[2].strip()
+            length = parts[4].strip()
             timestamp = parts[6].strip()
             
             if not artist or not track:
@@ -190,18 +733,243 @@ def parse_scrobbler_log(filepath, timezone_offset=0):
             except ValueError:
                 continue
             
-            scrobbles.append({
+            try:
+                length_int = int(length)
+            except ValueError:
+                length_int = 0
+            
+            chunk.append({
                 'artist': artist,
                 'title': track,
                 'album': album if album else '',
                 'timestamp': timestamp_int,
+                'length': length_int,
                 'date_str': scrobble_date.strftime('%Y-%m-%d %H:%M:%S'),
-                'was_adjusted': False
+                'was_adjusted': False,
+                'line_num': line_num,
+                # Identifica la reproducción por los datos del archivo, antes de cualquier ajuste
+                'play_id': f"{timestamp}\t{artist}\t{track}"
             })
+            
+            if len(chunk) >= chunk_size:
+                yield chunk, bytes_read
+                chunk = []
+    
+    yield chunk, bytes_read
+
+
+def last_submitted_line(line_nums, handled_lines):
+    """
+    Devuelve el número de la última línea del prefijo del archivo cuyas
+    canciones ya se enviaron todas (0 si la primera quedó pendiente).
+    """
+    last = 0
+    for line_num in sorted(line_nums):
+        if line_num not in handled_lines:
+            break
+        last = line_num
+    return last
+
+
+def append_archive_part(part_path, archive_path):
+    """Añade al archivo local un miembro gzip ya escrito en part_path y lo borra"""
+    with open(part_path, 'rb') as part, open(archive_path, 'ab') as archive:
+        while True:
+            block = part.read(1024 * 1024)
+            if not block:
+                break
+            archive.write(block)
+        archive.flush()
+        os.fsync(archive.fileno())
+    os.remove(part_path)
+
+
+def archive_submitted_lines(filepath, last_line, archive_path=ARCHIVE_FILE):
+    """
+    Mueve las líneas 1..last_line del .scrobbler.log a un archivo comprimido local
+    y reescribe el log del dispositivo con la cabecera de Rockbox y las líneas pendientes.
+    Trabaja línea a línea y reemplaza el archivo de forma atómica.
+    Las líneas archivadas se escriben primero en archive_path + '.part' y solo
+    se añaden al archivo tras reemplazar el del dispositivo; si eso falla, el
+    .part queda en disco y se añade en la siguiente llamada.
+    Devuelve el número de líneas archivadas.
+    """
+    part_path = archive_path + '.part'
+    if os.path.exists(part_path):
+        # Un intento anterior recortó el dispositivo pero no llegó a archivar
+        append_archive_part(part_path, archive_path)
+    
+    if last_line <= 0:
+        return 0
+    
+    tmp_path = filepath + '.tmp'
+    archived = 0
+    in_header = True
+    replaced = False
     
+    try:
+        with open(filepath, 'rb') as src, \
+             open(tmp_path, 'wb') as dst, \
+             open(part_path, 'wb') as part_file:
+            with gzip.GzipFile(fileobj=part_file, mode='wb') as part:
+                for line_num, line in enumerate(src, 1):
+                    if in_header and line.startswith(b'#'):
+                        dst.write(line)
+                        continue
+                    in_header = False
+                    
+                    if line_num <= last_line:
+                        part.write(line)
+                        archived += 1
+                    else:
+                        dst.write(line)
+            
+            # Las líneas archivadas deben estar en disco antes de tocar el dispositivo
+            part_file.flush()
+            os.fsync(part_file.fileno())
+            dst.flush()
+            os.fsync(dst.fileno())
+        
+        os.replace(tmp_path, filepath)
+        replaced = True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if not replaced and os.path.exists(part_path):
+            os.remove(part_path)
+    
+    append_archive_part(part_path, archive_path)
+    return archived
+
+
+@profiled
+def parse_scrobbler_log(filepath, timezone_offset=0):
+    """Parsea el archivo .scrobbler.log de Rockbox"""
+    scrobbles = []
+    for chunk, _ in iter_scrobbler_log(filepath, timezone_offset):
+        scrobbles.extend(chunk)
     return scrobbles
 
 
+# =============================================================================
+# DETECCIÓN DEL REPRODUCTOR
+# =============================================================================
+
+def mount_roots():
+    """Carpetas donde el sistema monta los dispositivos USB"""
+    user = getpass.getuser()
+    roots = [
+        os.path.join('/media', user),
+        '/media',
+        os.path.join('/run/media', user),
+        '/mnt',
+        '/Volumes',
+    ]
+    return [root for root in roots if os.path.isdir(root)]
+
+
+def find_scrobbler_logs():
+    """Devuelve las rutas de .scrobbler.log en la raíz de los volúmenes montados"""
+    if os.name == 'nt':
+        volumes = [f"{letter}:\\" for letter in string.ascii_uppercase[2:]]
+    else:
+        volumes = []
+        for root in mount_roots():
+            try:
+                with os.scandir(root) as entries:
+                    volumes.extend(entry.path for entry in entries if entry.is_dir())
+            except OSError:
+                continue
+    
+    logs = set()
+    for volume in volumes:
+        path = os.path.join(volume, SCROBBLER_LOG_NAME)
+        if os.path.isfile(path):
+            logs.add(path)
+    return logs
+
+
+class DeviceWatcher:
+    """
+    Detecta reproductores Rockbox recién montados (con .scrobbler.log en la raíz).
+    Usa inotify si está disponible y si no consulta cada DEVICE_POLL_SECONDS.
+    Cuando el archivo deja de cambiar durante DEVICE_STABLE_SECONDS llama a
+    on_device(ruta) desde el hilo del detector; si devuelve False (no se pudo
+    aceptar todavía), lo vuelve a intentar en la siguiente revisión.
+    """
+
+    def __init__(self, on_device):
+        self.on_device = on_device
+        self.stop_event = threading.Event()
+        self.seen = set()
+        self.pending = {}  # ruta -> (tamaño, mtime, desde cuándo no cambia)
+
+    def start(self):
+        # Los reproductores ya conectados no cuentan como recién montados
+        self.seen = find_scrobbler_logs()
+        self.pending.clear()
+        # Evento nuevo en cada arranque para que un hilo anterior no siga vivo
+        self.stop_event = threading.Event()
+        thread = threading.Thread(target=self.run, args=(self.stop_event,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self, stop_event):
+        inotify = None
+        if INotify is not None:
+            try:
+                inotify = INotify()
+                mask = (inotify_flags.CREATE | inotify_flags.DELETE |
+                        inotify_flags.MOVED_TO | inotify_flags.MOVED_FROM)
+                for root in mount_roots():
+                    inotify.add_watch(root, mask)
+            except OSError:
+                inotify = None
+        
+        try:
+            while not stop_event.is_set():
+                if inotify:
+                    # Despierta en cuanto se monta algo; mientras tanto revisa igualmente
+                    inotify.read(timeout=DEVICE_POLL_SECONDS * 1000)
+                else:
+                    stop_event.wait(DEVICE_POLL_SECONDS)
+                
+                if not stop_event.is_set():
+                    self.check()
+        finally:
+            if inotify:
+                inotify.close()
+
+    def check(self):
+        present = find_scrobbler_logs()
+        now = time.time()
+        
+        # Un dispositivo desconectado vuelve a detectarse al conectarlo de nuevo
+        self.seen &= present
+        for path in list(self.pending):
+            if path not in present:
+                del self.pending[path]
+        
+        for path in present - self.seen:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            
+            signature = (stat.st_size, stat.st_mtime)
+            previous = self.pending.get(path)
+            if previous is None or previous[:2] != signature:
+                self.pending[path] = signature + (now,)
+                continue
+            
+            if now - previous[2] >= DEVICE_STABLE_SECONDS and self.on_device(path):
+                del self.pending[path]
+                self.seen.add(path)
+
+
 # =============================================================================
 # INTERFAZ GRÁFICA
 # =============================================================================
@@ -213,12 +981,30 @@ class ScrobblerGUI:
         self.root.geometry("1200x800")
         
         self.scrobbles = []
+        self.raw_scrobbles = []
         self.tree_items = {}
+        self.line_items = {}
+        self.shown_rows = {}  # fila -> (valores, ajustada) tal como se ven en la tabla
+        self.row_count = 0
+        self.checked_count = 0
+        self.refresh_id = 0
+        self.refreshing = False
+        self.load_id = 0
+        self.load_cancel = None
+        self.load_queue = queue.Queue()
+        self.loaded_path = None
+        self.import_lock = threading.Lock()
+        self.device_watcher = DeviceWatcher(self.on_device_connected)
+        self.waiting_devices = set()
+        self.loading = False
+        self.load_polling = False
         self.network = None
         self.username = DEFAULT_USERNAME
         self.password = DEFAULT_PASSWORD
         self.timezone_offset = 0
         self.logged_in = False
+        self.log_buffer = LogBuffer()
+        self.log_flush_scheduled = False
         
         # Verificar configuración de API
         if not API_KEY or API_KEY == 'TU_API_KEY_AQUI':
@@ -233,6 +1019,9 @@ class ScrobblerGUI:
         
         self.create_widgets()
         
+        if PROFILE_ENABLED:
+            self.log(f"Perfilado activo: informes en {PROFILE_DIR}")
+        
         # Intentar cargar sesión guardada o usar .env
         session = load_session()
         if session:
@@ -288,6 +1077,24 @@ class ScrobblerGUI:
         
         ttk.Button(file_frame, text="Seleccionar archivo", command=self.select_file).pack(side=tk.LEFT, padx=5)
         
+        auto_frame = ttk.Frame(top_frame)
+        auto_frame.pack(fill=tk.X, pady=(5, 0))
+        
+        self.auto_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(auto_frame, text="Importar automáticamente al conectar el reproductor",
+                        variable=self.auto_var, command=self.toggle_device_watcher).pack(side=tk.LEFT, padx=5)
+        
+        # Progreso de carga
+        load_frame = ttk.Frame(top_frame)
+        load_frame.pack(fill=tk.X, pady=(5, 0))
+        
+        self.load_progress = ttk.Progressbar(load_frame, mode='determinate', maximum=100)
+        self.load_progress.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        
+        self.cancel_load_button = ttk.Button(load_frame, text="Cancelar carga",
+                                             command=self.cancel_load, state='disabled')
+        self.cancel_load_button.pack(side=tk.LEFT, padx=5)
+        
         # Advertencia
         warning_frame = ttk.Frame(self.root, padding="10")
         warning_frame.pack(fill=tk.X)
@@ -327,6 +1134,7 @@ class ScrobblerGUI:
         self.tree.heading("Álbum", text="Álbum")
         self.tree.heading("Fecha Original", text="Fecha Original")
         self.tree.heading("Fecha a Scrobblear", text="Fecha a Scrobblear")
+        self.tree.tag_configure("adjusted", foreground='orange')
         
         vsb = ttk.Scrollbar(table_frame, orient="vertical", command=self.tree.yview)
         hsb = ttk.Scrollbar(table_frame, orient="horizontal", command=self.tree.xview)
@@ -357,6 +1165,10 @@ class ScrobblerGUI:
         self.import_button = ttk.Button(action_frame, text="Importar a Last.fm", command=self.start_import)
         self.import_button.pack(side=tk.LEFT, padx=5)
         
+        self.archive_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(action_frame, text="Archivar y recortar el log del dispositivo",
+                        variable=self.archive_var).pack(side=tk.LEFT, padx=5)
+        
         self.progress = ttk.Progressbar(action_frame, mode='determinate')
         self.progress.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
         
@@ -541,10 +1353,21 @@ class ScrobblerGUI:
         self.update_timezone_example()
         
         filepath = self.file_entry.get()
-        if filepath and os.path.exists(filepath):
+        if self.loading:
+            # La carga recalcula las fechas con el desfase vigente al terminar
+            messagebox.showinfo("Ajuste pendiente",
+                                "El ajuste horario se aplicará al terminar la carga del archivo")
+            return
+        elif self.raw_scrobbles:
+            # Las fechas originales ya están en memoria: basta con recalcular
+            self.start_refresh()
+        elif filepath and os.path.exists(filepath):
             self.load_scrobbles(filepath)
-            messagebox.showinfo("Ajuste aplicado", 
-                              f"Se ajustaron {abs(self.timezone_offset)} horas {'adelante' if self.timezone_offset > 0 else 'atrás'}")
+        else:
+            return
+        
+        messagebox.showinfo("Ajuste aplicado", 
+                            f"Se ajustaron {abs(self.timezone_offset)} horas {'adelante' if self.timezone_offset > 0 else 'atrás'}")
     
     def select_file(self):
         filename = filedialog.askopenfilename(
@@ -558,57 +1381,254 @@ class ScrobblerGUI:
             self.load_scrobbles(filename)
     
     def load_scrobbles(self, filepath):
+        """Carga el archivo en segundo plano, mostrando las canciones según se leen"""
+        # Abortar la carga anterior invalida también sus mensajes pendientes
+        self.abort_load()
+        
+        self.load_cancel = threading.Event()
+        self.loading = True
+        self.loaded_path = filepath
+        
+        self.scrobbles = []
+        self.raw_scrobbles = []
+        for item in self.tree.get_children():
+            self.tree.delete(item)
+        self.tree_items.clear()
+        self.line_items.clear()
+        self.shown_rows.clear()
+        self.row_count = 0
+        self.checked_count = 0
+        self.update_count()
+        
+        self.load_progress['value'] = 0
+        self.cancel_load_button.config(state='normal')
+        self.log("Leyendo archivo...")
+        
+        thread = threading.Thread(target=self.load_worker,
+                                  args=(self.load_id, filepath, self.load_cancel))
+        thread.daemon = True
+        thread.start()
+        
+        if not self.load_polling:
+            self.load_polling = True
+            self.root.after(LOAD_POLL_MS, self.poll_load_queue)
+    
+    @profiled
+    def load_worker(self, load_id, filepath, cancel):
+        """
+        Hilo de carga: parsea por bloques y envía los resultados a la interfaz.
+        Las fechas se envían tal cual; el desfase y el ajuste se calculan al terminar
+        en otro hilo (start_refresh).
+        """
         try:
-            self.log("Leyendo archivo...")
+            total_bytes = os.path.getsize(filepath) or 1
+            found = 0
             
-            raw_scrobbles = parse_scrobbler_log(filepath, self.timezone_offset)
+            for chunk, bytes_read in iter_scrobbler_log(filepath):
+                if cancel.is_set():
+                    return
+                found += len(chunk)
+                self.load_queue.put(('chunk', load_id, chunk, bytes_read * 100 / total_bytes))
             
-            if not raw_scrobbles:
-                messagebox.showwarning("Advertencia", "No se encontraron scrobbles válidos")
+            if cancel.is_set():
                 return
             
-            two_weeks_ago = datetime.now() - timedelta(days=14)
-            adjusted_scrobbles, adjusted_count = adjust_old_scrobbles(raw_scrobbles, two_weeks_ago)
-            
-            self.scrobbles = adjusted_scrobbles
+            self.load_queue.put(('done', load_id) if found else ('empty', load_id))
             
-            for item in self.tree.get_children():
-                self.tree.delete(item)
-            
-            self.tree_items.clear()
+        except Exception as e:
+            self.load_queue.put(('error', load_id, str(e)))
+    
+    def poll_load_queue(self):
+        """
+        Procesa en el hilo de Tk los mensajes enviados por el hilo de carga.
+        Como mucho LOAD_CHUNKS_PER_TICK por vuelta, para que la ventana
+        (y el botón de cancelar) sigan respondiendo.
+        """
+        for _ in range(LOAD_CHUNKS_PER_TICK):
+            try:
+                message = self.load_queue.get_nowait()
+            except queue.Empty:
+                break
             
-            for idx, scrobble in enumerate(self.scrobbles):
-                original_date = scrobble.get('original_date', scrobble['date_str'])
-                scrobble_date = scrobble['date_str']
-                
-                tags = ("checked",)
-                if scrobble.get('was_adjusted'):
-                    tags = ("checked", "adjusted")
-                
-                item_id = self.tree.insert("", "end", text="☑", values=(
-                    scrobble['artist'],
-                    scrobble['title'],
-                    scrobble['album'],
-                    original_date,
-                    scrobble_date
-                ), tags=tags)
-                self.tree_items[item_id] = idx
-            
-            self.tree.tag_configure("adjusted", foreground='orange')
-            
-            self.update_count()
-            self.log(f"Cargadas {len(self.scrobbles)} canciones")
-            
-            if adjusted_count > 0:
-                self.log(f"Ajustadas {adjusted_count} canciones antiguas (naranja)")
-                messagebox.showinfo("Canciones ajustadas",
-                                  f"Se ajustaron {adjusted_count} canciones antiguas.\n\n"
-                                  f"Se distribuyeron en los últimos 14 días manteniendo\n"
-                                  f"el orden y la hora del día. Están en naranja.")
+            kind, load_id = message[0], message[1]
+            if load_id != self.load_id:
+                # Mensaje de una carga abortada
+                continue
             
+            if kind == 'chunk':
+                self.show_loaded_chunk(message[2])
+                self.load_progress['value'] = message[3]
+            elif kind == 'done':
+                self.load_progress['value'] = 100
+                self.log(f"Cargadas {len(self.raw_scrobbles)} canciones")
+                self.start_refresh(report=True)
+            elif kind == 'empty':
+                self.end_load()
+                messagebox.showwarning("Advertencia", "No se encontraron scrobbles válidos")
+            elif kind == 'error':
+                self.end_load()
+                messagebox.showerror("Error", f"Error al leer:\n{message[2]}")
+                self.log(f"Error: {message[2]}")
+        
+        if self.loading:
+            # Si quedan bloques en cola, seguir en cuanto Tk atienda sus eventos
+            delay = 1 if not self.load_queue.empty() else LOAD_POLL_MS
+            self.root.after(delay, self.poll_load_queue)
+        else:
+            self.load_polling = False
+    
+    def show_loaded_chunk(self, chunk):
+        """Inserta un bloque de canciones recién leídas, todavía sin ajustar"""
+        self.raw_scrobbles.extend(chunk)
+        for scrobble in apply_timezone_offset(chunk, self.timezone_offset):
+            values = self.row_values(scrobble)
+            item_id = self.tree.insert("", "end", text="☑", values=values, tags=("checked",))
+            self.tree_items[item_id] = len(self.scrobbles)
+            self.line_items[scrobble['line_num']] = item_id
+            self.shown_rows[item_id] = (values, False)
+            self.scrobbles.append(scrobble)
+        self.row_count += len(chunk)
+        self.checked_count += len(chunk)
+        self.update_count()
+    
+    def start_refresh(self, report=False):
+        """
+        Recalcula en segundo plano las fechas a partir de las originales (desfase
+        horario y ajuste a las 2 semanas). Un recálculo nuevo invalida el anterior.
+        """
+        self.refresh_id += 1
+        self.refreshing = True
+        
+        thread = threading.Thread(target=self.refresh_worker,
+                                  args=(self.refresh_id, self.raw_scrobbles, self.timezone_offset,
+                                        dict(self.line_items), dict(self.shown_rows), report))
+        thread.daemon = True
+        thread.start()
+    
+    @profiled
+    def refresh_worker(self, refresh_id, raw_scrobbles, timezone_offset, line_items, shown_rows, report):
+        """Hilo de recálculo: calcula las fechas y solo las filas que cambian"""
+        try:
+            shifted = apply_timezone_offset(raw_scrobbles, timezone_offset)
+            two_weeks_ago = datetime.now() - timedelta(days=SCROBBLE_WINDOW_DAYS)
+            scrobbles, adjusted_count = adjust_old_scrobbles(shifted, two_weeks_ago)
         except Exception as e:
-            messagebox.showerror("Error", f"Error al leer:\n{str(e)}")
-            self.log(f"Error: {str(e)}")
+            self.root.after(0, self.refresh_failed, refresh_id, str(e))
+            return
+        
+        tree_items = {}
+        updates = []
+        for idx, scrobble in enumerate(scrobbles):
+            item_id = line_items[scrobble['line_num']]
+            tree_items[item_id] = idx
+            row = (self.row_values(scrobble), bool(scrobble.get('was_adjusted')))
+            if shown_rows.get(item_id) != row:
+                updates.append((item_id,) + row)
+        
+        self.root.after(0, self.show_refreshed_rows, refresh_id, timezone_offset,
+                        scrobbles, tree_items, updates, adjusted_count, report)
+    
+    def show_refreshed_rows(self, refresh_id, timezone_offset, scrobbles, tree_items,
+                            updates, adjusted_count, report):
+        """Adopta el resultado de refresh_worker y actualiza las filas en bloques"""
+        if refresh_id != self.refresh_id:
+            return
+        if timezone_offset != self.timezone_offset:
+            # El desfase cambió mientras se calculaba
+            self.start_refresh(report)
+            return
+        
+        self.scrobbles = scrobbles
+        self.tree_items = tree_items
+        self.refreshing = False
+        self.apply_row_updates(refresh_id, updates, 0)
+        
+        if report:
+            self.end_load()
+            self.report_adjusted(adjusted_count)
+    
+    def refresh_failed(self, refresh_id, error):
+        if refresh_id != self.refresh_id:
+            return
+        self.refreshing = False
+        self.end_load()
+        messagebox.showerror("Error", f"Error al ajustar las fechas:\n{error}")
+        self.log(f"Error: {error}")
+    
+    def apply_row_updates(self, refresh_id, updates, start):
+        """Aplica como mucho LOAD_CHUNK_SIZE filas por vuelta, conservando la selección"""
+        if refresh_id != self.refresh_id:
+            return
+        
+        end = start + LOAD_CHUNK_SIZE
+        for item_id, values, adjusted in updates[start:end]:
+            checked = "checked" in self.tree.item(item_id, "tags")
+            tags = ("checked",) if checked else ("unchecked",)
+            if adjusted:
+                tags += ("adjusted",)
+            self.tree.item(item_id, values=values, tags=tags)
+            self.shown_rows[item_id] = (values, adjusted)
+        
+        if end < len(updates):
+            self.root.after(1, self.apply_row_updates, refresh_id, updates, end)
+    
+    def report_adjusted(self, adjusted_count):
+        if adjusted_count > 0:
+            self.log(f"Ajustadas {adjusted_count} canciones antiguas (naranja)")
+            shifts = [abs(s['shift']) for s in self.scrobbles if s.get('was_adjusted')]
+            moved = sum(1 for shift in shifts if shift)
+            if moved:
+                self.log(f"Movidas {moved} para evitar fechas repetidas "
+                         f"(máx. {max(shifts) // 60} min respecto a su hora original)")
+            messagebox.showinfo("Canciones ajustadas",
+                              f"Se ajustaron {adjusted_count} canciones antiguas.\n\n"
+                              f"Se distribuyeron en los últimos 14 días manteniendo\n"
+                              f"el orden y la hora del día. Están en naranja.")
+    
+    def row_values(self, scrobble):
+        original_date = scrobble.get('original_date', scrobble['date_str'])
+        return (
+            scrobble['artist'],
+            scrobble['title'],
+            scrobble['album'],
+            original_date,
+            scrobble['date_str']
+        )
+    
+    def abort_load(self):
+        """Aborta la carga en curso (si la hay) sin tocar la tabla"""
+        if self.load_cancel:
+            self.load_cancel.set()
+        self.load_id += 1
+        self.refresh_id += 1
+        self.refreshing = False
+        self.end_load()
+    
+    def end_load(self):
+        self.loading = False
+        self.load_cancel = None
+        self.cancel_load_button.config(state='disabled')
+    
+    def cancel_load(self):
+        """Cancela la carga a petición del usuario y descarta las filas parciales"""
+        if not self.loading:
+            return
+        self.abort_load()
+        self.loaded_path = None
+        
+        self.scrobbles = []
+        self.raw_scrobbles = []
+        for item in self.tree.get_children():
+            self.tree.delete(item)
+        self.tree_items.clear()
+        self.line_items.clear()
+        self.shown_rows.clear()
+        self.row_count = 0
+        self.checked_count = 0
+        self.update_count()
+        
+        self.load_progress['value'] = 0
+        self.log("Carga cancelada")
     
     def on_tree_click(self, event):
         region = self.tree.identify("region", event.x, event.y)
@@ -628,9 +1648,11 @@ class ScrobblerGUI:
         if "checked" in current_tags:
             new_tags = ("unchecked", "adjusted") if is_adjusted else ("unchecked",)
             self.tree.item(item, text="☐", tags=new_tags)
+            self.checked_count -= 1
         else:
             new_tags = ("checked", "adjusted") if is_adjusted else ("checked",)
             self.tree.item(item, text="☑", tags=new_tags)
+            self.checked_count += 1
         
         self.update_count()
     
@@ -640,6 +1662,7 @@ class ScrobblerGUI:
             is_adjusted = "adjusted" in current_tags
             new_tags = ("checked", "adjusted") if is_adjusted else ("checked",)
             self.tree.item(item, text="☑", tags=new_tags)
+        self.checked_count = self.row_count
         self.update_count()
     
     def deselect_all(self):
@@ -648,6 +1671,7 @@ class ScrobblerGUI:
             is_adjusted = "adjusted" in current_tags
             new_tags = ("unchecked", "adjusted") if is_adjusted else ("unchecked",)
             self.tree.item(item, text="☐", tags=new_tags)
+        self.checked_count = 0
         self.update_count()
     
     def invert_selection(self):
@@ -655,10 +1679,7 @@ class ScrobblerGUI:
             self.toggle_item(item)
     
     def update_count(self):
-        total = len(self.tree.get_children())
-        selected = sum(1 for item in self.tree.get_children() 
-                      if "checked" in self.tree.item(item, "tags"))
-        self.count_label.config(text=f"Canciones: {total} | Seleccionadas: {selected}")
+        self.count_label.config(text=f"Canciones: {self.row_count} | Seleccionadas: {self.checked_count}")
     
     def get_selected_scrobbles(self):
         selected = []
@@ -669,13 +1690,34 @@ class ScrobblerGUI:
         return selected
     
     def log(self, message):
+        self.log_buffer.append(message)
+        if not self.log_flush_scheduled:
+            self.log_flush_scheduled = True
+            self.root.after(LOG_FLUSH_MS, self.flush_log)
+    
+    def flush_log(self):
+        """Vuelca en bloque las líneas pendientes y recorta el widget al máximo"""
+        self.log_flush_scheduled = False
+        lines = self.log_buffer.take_pending()
+        if not lines:
+            return
+        
         self.log_text.config(state='normal')
-        self.log_text.insert(tk.END, f"{message}\n")
+        self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+        
+        line_count = int(self.log_text.index('end-1c').split('.')[0]) - 1
+        excess = line_count - self.log_buffer.max_lines
+        if excess > 0:
+            self.log_text.delete('1.0', f'{excess + 1}.0')
+        
         self.log_text.see(tk.END)
         self.log_text.config(state='disabled')
-        self.root.update()
     
     def start_import(self):
+        if self.loading or self.refreshing:
+            messagebox.showwarning("Advertencia", "Espera a que termine de cargarse el archivo")
+            return
+        
         if not self.logged_in:
             messagebox.showerror("Error", "Debes iniciar sesión primero")
             self.show_login_dialog()
@@ -687,22 +1729,59 @@ class ScrobblerGUI:
             messagebox.showwarning("Advertencia", "No hay canciones seleccionadas")
             return
         
-        adjusted_count = sum(1 for s in selected if s.get('was_adjusted'))
+        valid, rejected, replanned = prepare_submission(selected)
         
-        msg = f"¿Importar {len(selected)} canciones?\n\nUsuario: {self.username}"
+        if replanned:
+            self.log(f"Reajustadas {replanned} canciones que ya no cabían en las últimas 2 semanas")
+        if rejected:
+            self.log(f"Descartadas {len(rejected)} canciones antes de enviar:")
+            for scrobble, reason in rejected:
+                self.log(f"  [DESCARTADA: {REJECT_REASONS[reason]}] {scrobble['artist']} - {scrobble['title']}")
+        
+        if not valid:
+            messagebox.showwarning("Advertencia", "Ninguna de las canciones seleccionadas es válida para Last.fm")
+            return
+        
+        adjusted_count = sum(1 for s in valid if s.get('was_adjusted'))
+        
+        msg = f"¿Importar {len(valid)} canciones?\n\nUsuario: {self.username}"
         if adjusted_count > 0:
             msg += f"\n\nIncluye {adjusted_count} con fechas ajustadas"
+        if rejected:
+            msg += f"\n\nSe descartaron {len(rejected)} que Last.fm rechazaría (ver log)"
         
         if not messagebox.askyesno("Confirmar", msg):
             return
         
         self.import_button.config(state='disabled')
         
-        thread = threading.Thread(target=self.import_scrobbles, args=(selected,))
+        archive_path = self.loaded_path if self.archive_var.get() else None
+        loaded_lines = [s['line_num'] for s in self.scrobbles]
+        
+        thread = threading.Thread(target=self.run_import,
+                                  args=(valid, rejected, archive_path, loaded_lines))
         thread.daemon = True
         thread.start()
     
-    def import_scrobbles(self, scrobbles):
+    def run_import(self, *args, **kwargs):
+        """Ejecuta import_scrobbles sin solaparse con otra importación"""
+        with self.import_lock:
+            self.root.after(0, self.set_import_running, True)
+            self.import_scrobbles(*args, **kwargs)
+    
+    def set_import_running(self, running):
+        self.import_button.config(state='disabled' if running else 'normal')
+        if not running:
+            self.status_label.config(text="Listo")
+    
+    def show_import_progress(self, value, maximum, text):
+        """Actualiza la barra de progreso; se llama en el hilo de Tk mediante after()"""
+        self.progress['maximum'] = maximum
+        self.progress['value'] = value
+        self.status_label.config(text=text)
+    
+    @profiled
+    def import_scrobbles(self, scrobbles, rejected=(), archive_path=None, loaded_lines=(), notify=True):
         try:
             if not self.network:
                 password_hash = pylast.md5(self.password)
@@ -718,58 +1797,234 @@ class ScrobblerGUI:
             total = len(scrobbles)
             successful = 0
             failed = 0
+            unknown = 0
+            ignored = Counter()
+            # Líneas que no hace falta conservar en el dispositivo: aceptadas o
+            # rechazadas por motivos que el usuario no puede corregir
+            rejected = list(rejected)
+            handled_lines = {scrobble['line_num'] for scrobble, reason in rejected
+                             if reason in PERMANENT_REJECT_REASONS}
+            # Reproducciones a las que Last.fm ya respondió, para no reenviarlas
+            submitted_ids = set()
             
-            self.progress['maximum'] = total
-            self.progress['value'] = 0
+            self.root.after(0, self.show_import_progress, 0, total, f"0/{total}")
             
             self.log(f"\nIniciando importación de {total} canciones...")
             self.log("=" * 60)
             
-            import time
+            pending = scrobbles
+            rate = SUBMIT_INITIAL_RATE
+            sent = 0
+            batches = 0
             
-            for idx, scrobble in enumerate(scrobbles, 1):
-                try:
-                    self.network.scrobble(
-                        artist=scrobble['artist'],
-                        title=scrobble['title'],
-                        timestamp=scrobble['timestamp'],
-                        album=scrobble['album'] if scrobble['album'] else None
-                    )
-                    successful += 1
+            while pending:
+                # La lista llega ya planificada: replanificar con el ritmo medido solo
+                # si la primera pendiente corre peligro o cada SUBMIT_REPLAN_BATCHES lotes
+                head_at_risk = (scrobble_deadline(pending[0], time.time()) - SUBMIT_BATCH_SIZE / rate
+                                < SUBMIT_SAFETY_SECONDS)
+                if head_at_risk or (batches and batches % SUBMIT_REPLAN_BATCHES == 0):
+                    pending, dropped, replanned = prepare_submission(pending, rate)
+                    if replanned:
+                        self.log(f"{replanned} canciones caducarían antes de enviarse: "
+                                 f"se reajustan sus fechas (fin estimado en {int(len(pending) / rate) // 60} min)")
+                    for scrobble, reason in dropped:
+                        rejected.append((scrobble, reason))
+                        if reason in PERMANENT_REJECT_REASONS:
+                            handled_lines.add(scrobble['line_num'])
+                        self.log(f"[DESCARTADA: {REJECT_REASONS[reason]}] {scrobble['artist']} - {scrobble['title']}")
+                    if dropped:
+                        # Las descartadas ya no se enviarán: la barra debe poder llegar al final
+                        total -= len(dropped)
+                        self.root.after(0, self.show_import_progress, sent, max(total, 1), f"{sent}/{total}")
+                    if not pending:
+                        break
+                batches += 1
+                
+                batch = pending[:SUBMIT_BATCH_SIZE]
+                pending = pending[SUBMIT_BATCH_SIZE:]
+                started = time.time()
+                
+                for attempt in range(SUBMIT_RETRIES + 1):
+                    try:
+                        codes = submit_scrobbles(self.network, batch)
+                        error = None
+                        break
+                    except Exception as e:
+                        codes = []
+                        error = e
+                        if attempt < SUBMIT_RETRIES:
+                            self.log(f"Error al enviar el lote ({str(e)}), reintentando...")
+                            time.sleep(SUBMIT_RETRY_DELAY)
+                
+                for offset, scrobble in enumerate(batch):
+                    idx = sent + offset + 1
+                    
+                    if offset >= len(codes):
+                        failed += 1
+                        self.log(f"[{idx}/{total}] [ERROR] {scrobble['artist']} - {scrobble['title']}: "
+                                 f"{str(error) if error else 'sin respuesta'}")
+                        continue
                     
-                    status = "[AJUSTADA] " if scrobble.get('was_adjusted') else "[OK] "
-                    self.log(f"[{idx}/{total}] {status}{scrobble['artist']} - {scrobble['title']}")
+                    code = codes[offset]
+                    if code is None:
+                        # Puede que Last.fm la aceptara: no se reenvía, pero tampoco se archiva
+                        unknown += 1
+                        submitted_ids.add(scrobble['play_id'])
+                        self.log(f"[{idx}/{total}] [SIN CONFIRMAR] {scrobble['artist']} - {scrobble['title']}")
+                        continue
                     
-                except Exception as e:
-                    failed += 1
-                    self.log(f"[{idx}/{total}] [ERROR] {scrobble['artist']} - {scrobble['title']}: {str(e)}")
+                    if code == 0 or code in PERMANENT_IGNORED_CODES:
+                        handled_lines.add(scrobble['line_num'])
+                    if code != DAILY_LIMIT_CODE:
+                        submitted_ids.add(scrobble['play_id'])
+                    
+                    if code:
+                        ignored[code] += 1
+                        reason = IGNORED_CODES.get(code, f"código {code}")
+                        self.log(f"[{idx}/{total}] [IGNORADA: {reason}] {scrobble['artist']} - {scrobble['title']}")
+                    else:
+                        successful += 1
+                        status = "[AJUSTADA] " if scrobble.get('was_adjusted') else "[OK] "
+                        self.log(f"[{idx}/{total}] {status}{scrobble['artist']} - {scrobble['title']}")
+                
+                sent += len(batch)
+                self.root.after(0, self.show_import_progress, sent, total,
+                                f"{sent}/{total} (quedan ~{int(len(pending) / rate) // 60} min)")
                 
-                self.progress['value'] = idx
-                self.status_label.config(text=f"{idx}/{total}")
-                self.root.update()
+                # Con el límite diario alcanzado, el resto de envíos serían ignorados
+                if DAILY_LIMIT_CODE in codes:
+                    self.log(f"\nLímite diario de Last.fm alcanzado: se detiene la importación. "
+                             f"Quedan {len(pending)} canciones sin enviar; inténtalo mañana.")
+                    break
                 
                 time.sleep(0.1)
+                
+                # Media móvil del ritmo real (incluye la pausa entre lotes)
+                measured = len(batch) / max(time.time() - started, 0.001)
+                rate = 0.7 * rate + 0.3 * measured
             
             self.log("\n" + "=" * 60)
-            self.log(f"Exitosas: {successful} | Fallidas: {failed}")
+            self.log(f"Exitosas: {successful} | Ignoradas: {sum(ignored.values())} | "
+                     f"Fallidas: {failed} | Descartadas: {len(rejected)}")
+            for code, count in sorted(ignored.items()):
+                self.log(f"  Ignoradas por {IGNORED_CODES.get(code, f'código {code}')}: {count}")
+            if unknown:
+                self.log(f"  Sin confirmar (respuesta de Last.fm incompleta): {unknown}")
+            if pending:
+                self.log(f"  Sin enviar por el límite diario: {len(pending)}")
             self.log("=" * 60)
             
+            save_submitted(submitted_ids)
+            
+            if archive_path:
+                self.archive_device_log(archive_path, loaded_lines, handled_lines)
+            
             if successful > 0:
                 self.log(f"\nVerifica: https://www.last.fm/user/{self.username}")
-                messagebox.showinfo("Importación completada", 
-                                  f"Se importaron {successful} canciones exitosamente.\n\n"
-                                  f"Pueden tardar 1-2 minutos en aparecer en Last.fm.")
+            if successful > 0 and notify:
+                self.root.after(0, messagebox.showinfo, "Importación completada",
+                                f"Se importaron {successful} canciones exitosamente.\n\n"
+                                f"Pueden tardar 1-2 minutos en aparecer en Last.fm.")
             
         except Exception as e:
             self.log(f"\nError: {str(e)}")
-            messagebox.showerror("Error", str(e))
+            self.root.after(0, messagebox.showerror, "Error", str(e))
         
         finally:
-            self.import_button.config(state='normal')
-            self.status_label.config(text="Listo")
+            self.root.after(0, self.set_import_running, False)
+    
+    def toggle_device_watcher(self):
+        if self.auto_var.get():
+            self.device_watcher.start()
+            mode = "inotify" if INotify is not None else f"consulta cada {DEVICE_POLL_SECONDS} s"
+            self.log(f"Esperando a que se conecte el reproductor ({mode})...")
+        else:
+            self.device_watcher.stop()
+            self.log("Importación automática desactivada")
+    
+    def on_device_connected(self, filepath):
+        """
+        Llamado desde el hilo del detector. Devuelve False si todavía no se puede
+        importar (sin sesión): el detector lo reintentará hasta que se inicie sesión.
+        """
+        if not self.logged_in:
+            if filepath not in self.waiting_devices:
+                self.waiting_devices.add(filepath)
+                self.log(f"Reproductor detectado: {filepath}. Se importará al iniciar sesión")
+            return False
+        
+        self.waiting_devices.discard(filepath)
+        self.root.after(0, self.start_auto_import, filepath)
+        return True
+    
+    def start_auto_import(self, filepath):
+        """Lee la configuración en el hilo de Tk y lanza la importación en otro hilo"""
+        self.log(f"Reproductor detectado: {filepath}")
+        archive_path = filepath if self.archive_var.get() else None
+        
+        thread = threading.Thread(target=self.auto_import,
+                                  args=(filepath, self.timezone_offset, archive_path))
+        thread.daemon = True
+        thread.start()
+    
+    def auto_import(self, filepath, timezone_offset, archive_path):
+        """Lee, ajusta, valida y envía el log de un reproductor recién conectado"""
+        try:
+            # Al reconectar, el log sigue teniendo lo ya enviado si no se recortó
+            submitted = load_submitted()
+            raw_scrobbles = [s for s in parse_scrobbler_log(filepath, timezone_offset)
+                             if s['play_id'] not in submitted]
+            if not raw_scrobbles:
+                self.log("No hay canciones nuevas para importar")
+                return
+            
+            two_weeks_ago = datetime.now() - timedelta(days=SCROBBLE_WINDOW_DAYS)
+            adjusted_scrobbles, _ = adjust_old_scrobbles(raw_scrobbles, two_weeks_ago)
+            valid, rejected, _ = prepare_submission(adjusted_scrobbles)
+        except Exception as e:
+            self.log(f"Error al leer {filepath}: {str(e)}")
+            return
+        
+        if rejected:
+            self.log(f"Descartadas {len(rejected)} canciones que Last.fm rechazaría")
+        if not valid:
+            self.log("No hay canciones nuevas para importar")
+            return
+        
+        loaded_lines = [s['line_num'] for s in raw_scrobbles]
+        
+        self.run_import(valid, rejected, archive_path, loaded_lines, notify=False)
+    
+    def archive_device_log(self, filepath, loaded_lines, handled_lines):
+        """Archiva y recorta el .scrobbler.log del dispositivo tras importar"""
+        last_line = last_submitted_line(loaded_lines, handled_lines)
+        if not last_line:
+            self.log("No se recortó el log del dispositivo: la primera canción sigue pendiente")
+            return
+        
+        try:
+            archived = archive_submitted_lines(filepath, last_line)
+        except OSError as e:
+            self.log(f"Error al archivar el log del dispositivo: {str(e)}")
+            return
+        
+        # Los números de línea cargados ya no corresponden al archivo
+        if self.loaded_path == filepath:
+            self.loaded_path = None
+        self.log(f"Archivadas {archived} líneas en {ARCHIVE_FILE}")
+        self.log("Vuelve a cargar el archivo para ver las canciones pendientes")
 
 
 def main():
+    global PROFILE_ENABLED
+    
+    parser = argparse.ArgumentParser(description="Rockbox Scrobbler to Last.fm")
+    parser.add_argument('--profile', action='store_true',
+                        help=f"guarda perfiles de CPU y memoria en {PROFILE_DIR}")
+    args = parser.parse_args()
+    if args.profile:
+        PROFILE_ENABLED = True
+    
     root = tk.Tk()
     app = ScrobblerGUI(root)
     root.mainloop()